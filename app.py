@@ -2,22 +2,33 @@
 import os
 import re
 import time
+import queue
+import atexit
 import sqlite3
 import logging
 import requests
-import qrcode
+import segno
 import random
+import orjson
 import signal
+import threading
 from io import BytesIO
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from html import escape
 from dotenv import load_dotenv
-from telegram import Update, InputFile, ParseMode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from telegram import Bot, Update, InputFile, ParseMode
 from telegram.ext import (
     Updater,
     CommandHandler,
     CallbackContext,
     DispatcherHandlerStop
 )
+from telegram.ext import messagequeue as mq
+from telegram.ext.utils.promise import Promise
+from telegram.utils.request import Request
 
 # === 1. Load & validate environment variables ===
 load_dotenv()
@@ -32,6 +43,11 @@ MIN_WITHDRAWABLE_SATS  = int(os.getenv("MIN_WITHDRAWABLE_SATS", "21"))
 MAX_WITHDRAWABLE_SATS  = int(os.getenv("MAX_WITHDRAWABLE_SATS", "21"))
 ADMIN_TELEGRAM_ID      = int(os.getenv("ADMIN_TELEGRAM_ID", "0"))
 
+# === Telegram webhook settings (polling is used when no URL is set) ===
+TELEGRAM_WEBHOOK_URL    = os.getenv("TELEGRAM_WEBHOOK_URL")
+TELEGRAM_WEBHOOK_LISTEN = os.getenv("TELEGRAM_WEBHOOK_LISTEN", "0.0.0.0")
+TELEGRAM_WEBHOOK_PORT   = int(os.getenv("TELEGRAM_WEBHOOK_PORT", "8443"))
+
 # === Lucky voucher settings ===
 LUCKY_VOUCHER_ENABLED  = os.getenv("LUCKY_VOUCHER_ENABLED", "false").lower() == "true"
 LUCKY_VOUCHER_AMOUNT   = int(os.getenv("LUCKY_VOUCHER_AMOUNT", "10000"))
@@ -49,6 +65,60 @@ for var in ("LNBITS_API_KEY", "LNBITS_API_BASE", "TELEGRAM_BOT_TOKEN"):
 
 HEADERS = {"X-Api-Key": LNBITS_API_KEY}
 
+# Shared HTTP session so LNbits calls reuse the same TCP/TLS connection
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    # urllib3 only retries idempotent requests on these statuses, so this
+    # covers the CSV GET and never the create-link POST. 429 is left out so we
+    # don't keep hitting LNbits after it asked us to back off, and a 503's
+    # Retry-After is ignored so a refill can't stall on it. The last response
+    # is returned, not raised, so callers still log it via resp.ok
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[502, 503, 504],
+        raise_on_status=False,
+        respect_retry_after_header=False
+    )
+))
+atexit.register(SESSION.close)
+
+# LNbits endpoints and link payloads don't change at runtime, so the
+# payloads are serialized to JSON once here
+_LINKS_URL = f"{LNBITS_API_BASE}/withdraw/api/v1/links"
+_CSV_URL_FMT = f"{LNBITS_API_BASE}/withdraw/csv/{{}}"
+_JSON_HEADERS = {"Content-Type": "application/json"}
+_VOUCHER_LINK = {
+    "title": VOUCHER_TITLE,
+    "min_withdrawable": MIN_WITHDRAWABLE,
+    "max_withdrawable": MAX_WITHDRAWABLE,
+    "uses": VOUCHER_BATCH_SIZE,
+    "wait_time": 1,
+    "is_unique": True,
+    "webhook_url": WEBHOOK_URL
+}
+_LUCKY_LINK = {
+    **_VOUCHER_LINK,
+    "title": "Lucky Voucher",
+    "min_withdrawable": LUCKY_VOUCHER_AMOUNT,
+    "max_withdrawable": LUCKY_VOUCHER_AMOUNT,
+    "uses": LUCKY_VOUCHER_COUNT
+}
+_VOUCHER_PAYLOAD = orjson.dumps(_VOUCHER_LINK)
+_LUCKY_PAYLOAD = orjson.dumps(_LUCKY_LINK)
+
+# A well-formed LNURL (after upper-casing)
+_LNURL_RE = re.compile(r'^LNURL[0-9A-Z]+$')
+# Finds LNURLs embedded in an HTML page returned instead of the CSV export
+_LNURL_FIND_RE = re.compile(r'\b(LNURL[0-9A-Z]{50,})\b')
+
+# Detects such an HTML page within the first few KB of the response
+_HTML_SNIFF_RE = re.compile(r'<(?:html|body|script)', re.IGNORECASE)
+_HTML_SNIFF_CHARS = 4096
+
 # === Logging setup ===
 logging.basicConfig(
     format="%(asctime)s %(levelname)s: %(message)s",
@@ -57,53 +127,116 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # === 2. Database initialization ===
+def _connect():
+    """Open the bot database in autocommit mode with the tuned pragmas applied"""
+    conn = sqlite3.connect("db.sqlite3", timeout=10, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+class ConnectionPool:
+    """Fixed set of long-lived connections handed out one thread at a time"""
+
+    def __init__(self, size: int = 4):
+        self._conns = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._conns.put(_connect())
+
+    @contextmanager
+    def acquire(self):
+        conn = self._conns.get()
+        try:
+            yield conn
+        finally:
+            self._conns.put(conn)
+
+    def close(self):
+        while not self._conns.empty():
+            self._conns.get_nowait().close()
+
+# Created by init_db; writers still serialize inside SQLite via BEGIN IMMEDIATE
+POOL = None
+
+# Chats that already claimed their voucher, so repeat claims skip the database
+CLAIMED_IDS = set()
+
+# Running lucky win totals, loaded in init_db and updated by record_lucky_win
+_LUCKY_CACHE = {"wins": 0, "amount": 0}
+_LUCKY_LOCK = threading.Lock()
+
 def init_db():
-    conn = sqlite3.connect("db.sqlite3", timeout=10)
-    c = conn.cursor()
-    c.execute('''
+    global POOL
+    POOL = ConnectionPool()
+    atexit.register(POOL.close)
+
+    with POOL.acquire() as conn:
+        _create_schema(conn)
+
+def _create_schema(conn):
+    conn.execute('''
       CREATE TABLE IF NOT EXISTS vouchers (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        id INTEGER PRIMARY KEY,
         lnurl TEXT     NOT NULL UNIQUE,
         link_id TEXT   NOT NULL,
         assigned_to TEXT UNIQUE,
         used    BOOLEAN DEFAULT 0,
         bonus   BOOLEAN DEFAULT 0,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        claimed_by INTEGER,
+        admin_flag INTEGER DEFAULT 0
       )
     ''')
+
+    # Migrate older databases that only tracked claims via assigned_to tags
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(vouchers)")}
+    if "claimed_by" not in columns:
+        # The connection autocommits, so group the steps into one transaction;
+        # a crash midway must not leave claimed_by without admin_flag
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("ALTER TABLE vouchers ADD COLUMN claimed_by INTEGER")
+            conn.execute("ALTER TABLE vouchers ADD COLUMN admin_flag INTEGER DEFAULT 0")
+            conn.execute(
+                "UPDATE vouchers SET claimed_by = CAST(assigned_to AS INTEGER) "
+                "WHERE bonus = 0 AND CAST(CAST(assigned_to AS INTEGER) AS TEXT) = assigned_to"
+            )
+        logger.info("Migrated vouchers table to claimed_by/admin_flag columns")
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vouchers_claimed_by ON vouchers(claimed_by)")
     
     # Add lucky wins tracking
-    c.execute('''
+    conn.execute('''
       CREATE TABLE IF NOT EXISTS lucky_wins (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        id INTEGER PRIMARY KEY,
         chat_id TEXT NOT NULL,
         username TEXT,
         amount INTEGER NOT NULL,
         won_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
       )
     ''')
-    conn.commit()
-    conn.close()
+
+    CLAIMED_IDS.update(
+        str(row[0]) for row in
+        conn.execute("SELECT DISTINCT claimed_by FROM vouchers WHERE claimed_by IS NOT NULL AND admin_flag = 0")
+    )
+
+    total_wins, total_amount = conn.execute("SELECT COUNT(*), SUM(amount) FROM lucky_wins").fetchone()
+    with _LUCKY_LOCK:
+        _LUCKY_CACHE["wins"] = total_wins or 0
+        _LUCKY_CACHE["amount"] = total_amount or 0
 
 def clean_database():
     """Remove invalid LNURL entries (HTML fragments) from database"""
-    conn = sqlite3.connect("db.sqlite3", timeout=10)
-    c = conn.cursor()
-    
-    # Find and remove invalid entries
-    c.execute("SELECT id, lnurl FROM vouchers")
-    all_vouchers = c.fetchall()
-    
-    invalid_count = 0
-    for voucher_id, lnurl in all_vouchers:
-        # Check if it's a valid LNURL (should start with LNURL and be alphanumeric)
-        if not lnurl.startswith('LNURL') or not re.match(r'^LNURL[0-9A-Z]+$', lnurl.upper()):
-            c.execute("DELETE FROM vouchers WHERE id = ?", (voucher_id,))
-            invalid_count += 1
-            logger.info(f"Removed invalid entry: {lnurl[:50]}...")
-    
-    conn.commit()
-    conn.close()
+    # A valid LNURL starts with "LNURL" followed by letters and digits only;
+    # GLOB is case-sensitive, so this runs as one statement inside SQLite
+    with POOL.acquire() as conn:
+        invalid_count = conn.execute(
+            "DELETE FROM vouchers "
+            "WHERE lnurl NOT GLOB 'LNURL?*' OR lnurl GLOB 'LNURL*[^0-9A-Za-z]*'"
+        ).rowcount
     
     if invalid_count > 0:
         logger.info(f"Cleaned {invalid_count} invalid entries from database")
@@ -113,21 +246,11 @@ def clean_database():
 # === 3a. Create normal voucher group & import ===
 def create_voucher_group():
     logger.info(f"Creating voucher group ({VOUCHER_BATCH_SIZE} uses)...")
-    url = f"{LNBITS_API_BASE}/withdraw/api/v1/links"
-    payload = {
-        "title": VOUCHER_TITLE,
-        "min_withdrawable": MIN_WITHDRAWABLE,
-        "max_withdrawable": MAX_WITHDRAWABLE,
-        "uses": VOUCHER_BATCH_SIZE,
-        "wait_time": 1,
-        "is_unique": True,
-        "webhook_url": WEBHOOK_URL
-    }
-    resp = requests.post(url, json=payload, headers=HEADERS, timeout=10)
+    resp = SESSION.post(_LINKS_URL, data=_VOUCHER_PAYLOAD, headers=_JSON_HEADERS, timeout=10)
     if not resp.ok:
         logger.error("Failed to create voucher group: %s %s", resp.status_code, resp.text)
         return
-    link_id = resp.json().get("id")
+    link_id = orjson.loads(resp.content).get("id")
     logger.info("Voucher group created: %s", link_id)
     fetch_and_store_lnurls(link_id)
 
@@ -136,260 +259,260 @@ def create_lucky_vouchers():
     if not LUCKY_VOUCHER_ENABLED:
         return
     logger.info(f"Creating {LUCKY_VOUCHER_COUNT} lucky vouchers ({LUCKY_VOUCHER_AMOUNT} sats each)...")
-    url = f"{LNBITS_API_BASE}/withdraw/api/v1/links"
-    payload = {
-        "title": "Lucky Voucher",
-        "min_withdrawable": LUCKY_VOUCHER_AMOUNT,
-        "max_withdrawable": LUCKY_VOUCHER_AMOUNT,
-        "uses": LUCKY_VOUCHER_COUNT,
-        "wait_time": 1,
-        "is_unique": True,
-        "webhook_url": WEBHOOK_URL
-    }
-    resp = requests.post(url, json=payload, headers=HEADERS, timeout=10)
+    resp = SESSION.post(_LINKS_URL, data=_LUCKY_PAYLOAD, headers=_JSON_HEADERS, timeout=10)
     if not resp.ok:
         logger.error("Failed to create lucky vouchers: %s %s", resp.status_code, resp.text)
         return
-    link_id = resp.json().get("id")
-
-    csv_url = f"{LNBITS_API_BASE}/withdraw/csv/{link_id}"
-    headers = {**HEADERS, "Accept": "text/csv"}
-    resp = requests.get(csv_url, headers=headers, timeout=10)
-    if not resp.ok:
-        logger.error("Failed to fetch lucky vouchers CSV: %s %s", resp.status_code, resp.text)
-        return
-
-    lnurls = extract_lnurls_from_response(resp.text)
-    if lnurls:
-        conn = sqlite3.connect("db.sqlite3", timeout=10)
-        c = conn.cursor()
-        for lnurl in lnurls:
-            try:
-                c.execute(
-                    "INSERT INTO vouchers (lnurl, link_id, bonus) VALUES (?, ?, 1)",
-                    (lnurl, link_id)
-                )
-            except sqlite3.IntegrityError:
-                pass
-        conn.commit()
-        conn.close()
-        logger.info(f"Stored {len(lnurls)} lucky vouchers.")
-    else:
-        logger.error("No valid LNURLs found in lucky voucher response")
+    link_id = orjson.loads(resp.content).get("id")
+    logger.info("Lucky voucher group created: %s", link_id)
+    fetch_and_store_lnurls(link_id, bonus=True)
 
 # === 3a. (cont'd) Improved LNURL extraction ===
-def extract_lnurls_from_response(response_text):
-    """Extract valid LNURLs from response, handling both CSV and HTML responses"""
-    text = response_text.strip()
-    
-    # Check if response looks like HTML
-    if "<html" in text.lower() or "<body" in text.lower() or "<script" in text.lower():
-        logger.warning("Received HTML response instead of CSV, extracting LNURLs via regex")
-        # Use more specific regex to find valid LNURLs
-        lnurls = re.findall(r'\b(LNURL[0-9A-Z]{50,})\b', text.upper())
-    else:
-        # Treat as CSV - split by lines and filter
-        lines = text.splitlines()
-        lnurls = []
-        for line in lines:
-            line = line.strip()
-            # Check if line looks like a valid LNURL
-            if line.startswith('LNURL') and re.match(r'^LNURL[0-9A-Z]+$', line.upper()):
-                lnurls.append(line.upper())
-    
-    # Additional validation - ensure LNURLs are proper length and format
-    valid_lnurls = []
-    for lnurl in lnurls:
-        # LNURL should be at least 50 characters and only contain valid characters
-        if len(lnurl) >= 50 and re.match(r'^LNURL[0-9A-Z]+$', lnurl):
-            valid_lnurls.append(lnurl)
-        else:
-            logger.warning(f"Skipping invalid LNURL: {lnurl}")
-    
-    # Remove duplicates while preserving order
-    seen = set()
-    unique_lnurls = []
-    for lnurl in valid_lnurls:
-        if lnurl not in seen:
-            seen.add(lnurl)
-            unique_lnurls.append(lnurl)
-    
-    logger.info(f"Extracted {len(unique_lnurls)} valid LNURLs from response")
-    return unique_lnurls
+def extract_lnurls_from_response(lines):
+    """Extract valid LNURLs from response lines, handling both CSV and HTML responses"""
+    # Validate and deduplicate in a single pass; a dict keeps insertion order
+    unique_lnurls = {}
+    is_html = False
+    sniff_budget = _HTML_SNIFF_CHARS
+    for line in lines:
+        line = line.strip()
+
+        # Check if response looks like HTML; the tags show up right at the start
+        if not is_html and sniff_budget > 0:
+            sniff_budget -= len(line)
+            if _HTML_SNIFF_RE.search(line):
+                logger.warning("Received HTML response instead of CSV, extracting LNURLs via regex")
+                is_html = True
+
+        if is_html:
+            # The regex already enforces the LNURL alphabet and minimum length
+            for lnurl in _LNURL_FIND_RE.findall(line.upper()):
+                unique_lnurls[lnurl] = None
+        elif line.startswith('LNURL'):
+            # Treat as CSV - one LNURL per line, upper-cased only when needed
+            if not _LNURL_RE.match(line):
+                line = line.upper()
+                if not _LNURL_RE.match(line):
+                    continue
+            # LNURL should be at least 50 characters
+            if len(line) >= 50:
+                unique_lnurls[line] = None
+            else:
+                logger.warning(f"Skipping invalid LNURL: {line}")
 
-def fetch_and_store_lnurls(link_id: str):
-    csv_url = f"{LNBITS_API_BASE}/withdraw/csv/{link_id}"
-    headers = {**HEADERS, "Accept": "text/csv"}
-    resp = requests.get(csv_url, headers=headers, timeout=10)
-    if not resp.ok:
-        logger.error("Failed to fetch CSV: %s %s", resp.status_code, resp.text)
-        return
+    logger.info(f"Extracted {len(unique_lnurls)} valid LNURLs from response")
+    return list(unique_lnurls)
+
+def fetch_and_store_lnurls(link_id: str, bonus: bool = False):
+    csv_url = _CSV_URL_FMT.format(link_id)
+    # Stream the CSV and parse it line by line instead of decoding it all at once
+    with SESSION.get(csv_url, headers={"Accept": "text/csv"}, stream=True, timeout=10) as resp:
+        if not resp.ok:
+            logger.error("Failed to fetch CSV for %s: %s %s", link_id, resp.status_code, resp.text)
+            return
+        resp.encoding = resp.encoding or "utf-8"
+        lnurls = extract_lnurls_from_response(resp.iter_lines(decode_unicode=True))
 
-    lnurls = extract_lnurls_from_response(resp.text)
     if lnurls:
-        save_lnurls_to_db(lnurls, link_id)
+        save_lnurls_to_db(lnurls, link_id, bonus=bonus)
     else:
         logger.error("No valid LNURLs found in response")
 
-def save_lnurls_to_db(lnurls: list, link_id: str):
-    conn = sqlite3.connect("db.sqlite3", timeout=10)
-    c = conn.cursor()
-    saved_count = 0
-    for lnurl in lnurls:
-        try:
-            c.execute(
-                "INSERT INTO vouchers (lnurl, link_id) VALUES (?, ?)",
-                (lnurl, link_id)
-            )
-            saved_count += 1
-        except sqlite3.IntegrityError:
-            logger.debug(f"LNURL already exists: {lnurl[:20]}...")
-    conn.commit()
-    conn.close()
+def save_lnurls_to_db(lnurls: list, link_id: str, bonus: bool = False):
+    # One bulk statement in one transaction; duplicates are skipped by SQLite
+    with POOL.acquire() as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        saved_count = conn.executemany(
+            "INSERT OR IGNORE INTO vouchers (lnurl, link_id, bonus) VALUES (?, ?, ?)",
+            [(lnurl, link_id, int(bonus)) for lnurl in lnurls]
+        ).rowcount
     logger.info(f"Saved {saved_count} new LNURLs to database")
 
 # === 4. Claim logic ===
 def has_received(chat_id: str) -> bool:
-    conn = sqlite3.connect("db.sqlite3", timeout=10)
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM vouchers WHERE assigned_to = ?", (chat_id,))
-    count = c.fetchone()[0]
-    conn.close()
-    return count > 0
+    return chat_id in CLAIMED_IDS
 
 def get_lucky_stats():
     """Get statistics about lucky wins"""
-    conn = sqlite3.connect("db.sqlite3", timeout=10)
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*), SUM(amount) FROM lucky_wins")
-    result = c.fetchone()
-    conn.close()
-    total_wins = result[0] or 0
-    total_amount = result[1] or 0
-    return total_wins, total_amount
+    with _LUCKY_LOCK:
+        return _LUCKY_CACHE["wins"], _LUCKY_CACHE["amount"]
 
 def record_lucky_win(chat_id: str, username: str, amount: int):
     """Record a lucky win in the database"""
-    conn = sqlite3.connect("db.sqlite3", timeout=10)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO lucky_wins (chat_id, username, amount) VALUES (?, ?, ?)",
-        (chat_id, username, amount)
-    )
-    conn.commit()
-    conn.close()
+    with POOL.acquire() as conn:
+        conn.execute(
+            "INSERT INTO lucky_wins (chat_id, username, amount) VALUES (?, ?, ?)",
+            (chat_id, username, amount)
+        )
+    # Only count the win once it is stored, so the totals match lucky_wins
+    with _LUCKY_LOCK:
+        _LUCKY_CACHE["wins"] += 1
+        _LUCKY_CACHE["amount"] += amount
 
 def assign_voucher(chat_id: str, is_admin: bool = False):
-    conn = sqlite3.connect("db.sqlite3", timeout=10)
-    c = conn.cursor()
-
-    # 1. Assign normal voucher - only select valid LNURLs
-    c.execute(
-        "SELECT lnurl, link_id FROM vouchers "
-        "WHERE assigned_to IS NULL AND bonus = 0 AND lnurl LIKE 'LNURL%' "
-        "LIMIT 1"
-    )
-    normal = c.fetchone()
-    if not normal:
-        logger.info("No unassigned normal vouchers, creating new batch")
-        conn.close()
-        create_voucher_group()
-        conn = sqlite3.connect("db.sqlite3", timeout=10)
-        c = conn.cursor()
-        c.execute(
-            "SELECT lnurl, link_id FROM vouchers "
-            "WHERE assigned_to IS NULL AND bonus = 0 AND lnurl LIKE 'LNURL%' "
-            "LIMIT 1"
-        )
-        normal = c.fetchone()
+    """Assign vouchers to a chat and report the remaining free supply.
 
-    lucky = None
-    if normal:
-        lnurl_n, link_id_n = normal
-        assign_tag = f"{chat_id}-{time.time_ns()}" if is_admin else chat_id
-        c.execute("UPDATE vouchers SET assigned_to = ? WHERE lnurl = ?", (assign_tag, lnurl_n))
+    Returns (normal, lucky, free_normal, free_lucky), or None if the chat
+    has already claimed its voucher.
+    """
+    with POOL.acquire() as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
 
-        # 2. Possibly assign a lucky bonus voucher
-        if LUCKY_VOUCHER_ENABLED and random.random() < LUCKY_VOUCHER_CHANCE:
-            c.execute(
-                "SELECT lnurl, link_id FROM vouchers "
+        # 1. Assign normal voucher - only valid LNURLs, and only if this chat
+        #    holds none yet (admins may claim any number of times)
+        assign_tag = f"{chat_id}-{time.time_ns()}" if is_admin else chat_id
+        claimed_by = int(chat_id)
+        normal = conn.execute(
+            "UPDATE vouchers SET assigned_to = ?, claimed_by = ?, admin_flag = ? WHERE id = ("
+            "SELECT id FROM vouchers "
+            "WHERE assigned_to IS NULL AND bonus = 0 AND lnurl LIKE 'LNURL%' "
+            "AND (? OR NOT EXISTS (SELECT 1 FROM vouchers WHERE claimed_by = ? AND admin_flag = 0)) "
+            "LIMIT 1"
+            ") RETURNING lnurl, link_id",
+            (assign_tag, claimed_by, is_admin, is_admin, claimed_by)
+        ).fetchone()
+        lucky = None
+        already_claimed = False
+        if not normal:
+            # Tell an empty pool apart from a repeat claim
+            if not is_admin:
+                already_claimed = conn.execute(
+                    "SELECT 1 FROM vouchers WHERE claimed_by = ? AND admin_flag = 0 LIMIT 1", (claimed_by,)
+                ).fetchone() is not None
+        elif LUCKY_VOUCHER_ENABLED and random.random() < LUCKY_VOUCHER_CHANCE:
+            # 2. Possibly assign a lucky bonus voucher; they all carry the
+            #    same amount, so any free one will do
+            lucky = conn.execute(
+                "UPDATE vouchers SET assigned_to = ?, claimed_by = ?, admin_flag = ? WHERE id = ("
+                "SELECT id FROM vouchers "
                 "WHERE assigned_to IS NULL AND bonus = 1 AND lnurl LIKE 'LNURL%' "
-                "ORDER BY RANDOM() LIMIT 1"
-            )
-            lucky_row = c.fetchone()
-            if lucky_row:
-                lnurl_l, link_id_l = lucky_row
-                c.execute(
-                    "UPDATE vouchers SET assigned_to = ? WHERE lnurl = ?",
-                    (assign_tag + "-bonus", lnurl_l)
-                )
-                lucky = (lnurl_l, link_id_l)
-
-        conn.commit()
-        conn.close()
-        return (lnurl_n, link_id_n), lucky
-
-    conn.close()
-    return None, None
+                "LIMIT 1"
+                ") RETURNING lnurl, link_id",
+                (assign_tag + "-bonus", claimed_by, is_admin)
+            ).fetchone()
+
+        if not already_claimed:
+            # 3. Remaining supply, so the caller can decide whether to refill
+            free_normal, free_lucky = conn.execute(
+                "SELECT COALESCE(SUM(bonus = 0), 0), COALESCE(SUM(bonus = 1), 0) FROM vouchers "
+                "WHERE assigned_to IS NULL AND lnurl LIKE 'LNURL%'"
+            ).fetchone()
+
+    # Remember the claim only once the transaction has committed, so a failed
+    # write doesn't lock the chat out without a voucher
+    if not is_admin and (normal or already_claimed):
+        CLAIMED_IDS.add(chat_id)
+    if already_claimed:
+        return None
+    return normal, lucky, free_normal, free_lucky
 
 # === 5. Fixed Telegram Handlers ===
+# QR rendering and photo uploads run here so they don't block the dispatcher
+QR_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="qr")
+
+# Voucher messages; only the username {u} and the LNURL {l} vary per send
+_TEMPLATE_BONUS = (
+    f"🍀 <b>Lucky Bonus!</b>\n"
+    f"You've won an additional <b>{LUCKY_VOUCHER_AMOUNT:,} sats</b>, @{{u}}!\n\n"
+    f"<b>Voucher Code:</b>\n"
+    f"<code>{{l}}</code>\n\n"
+    f"💡 <i>Tap the code above to copy it, then paste into your Lightning wallet</i>"
+)
+_TEMPLATE_NORMAL = (
+    f"Here are your <b>{MIN_WITHDRAWABLE_SATS} sats</b>, @{{u}}.\n\n"
+    f"<b>Voucher Code:</b>\n"
+    f"<code>{{l}}</code>\n\n"
+    f"💡 <i>Tap the code above to copy it, then paste into your Lightning wallet</i>"
+)
+if LUCKY_VOUCHER_ENABLED:
+    _TEMPLATE_NORMAL += (
+        f"\n\n🎯 <i>You had a {LUCKY_VOUCHER_CHANCE * 100:.2f}% chance "
+        f"for a {LUCKY_VOUCHER_AMOUNT:,} sat bonus</i>"
+    )
+
+# /start, /info and /lucky texts; only the user and the lucky totals vary per call
+_WELCOME_TMPL = (
+    f"⚡ <b>Lightning Voucher Bot</b>\n\n"
+    f"Welcome @{{usr}}! Get your free <b>{MIN_WITHDRAWABLE_SATS} sats</b> with /getvoucher\n\n"
+)
+if LUCKY_VOUCHER_ENABLED:
+    _WELCOME_TMPL += (
+        f"🍀 <b>Lucky Feature Active!</b>\n"
+        f"• {LUCKY_VOUCHER_CHANCE * 100:.2f}% chance to win <b>{LUCKY_VOUCHER_AMOUNT:,} bonus sats</b>\n"
+        f"• {{wins}} lucky winners so far\n"
+        f"• {{amount:,}} bonus sats distributed\n\n"
+    )
+_WELCOME_TMPL += (
+    f"<b>Commands:</b>\n"
+    f"• /getvoucher - Claim your sats\n"
+    f"• /info - About lucky bonuses\n"
+    f"• /lucky - Lucky statistics"
+)
+
+_INFO_TMPL = (
+    f"🍀 <b>Lucky Bonus Feature</b>\n\n"
+    f"<b>How it works:</b>\n"
+    f"• {LUCKY_VOUCHER_CHANCE * 100:.2f}% chance per claim\n"
+    f"• Winners get an extra <b>{LUCKY_VOUCHER_AMOUNT:,} sats</b>\n"
+    f"• Completely random and automatic\n\n"
+    f"<b>Statistics:</b>\n"
+    f"• {{wins}} lucky winners\n"
+    f"• {{amount:,}} bonus sats distributed\n"
+    f"• Average: {{average:,.0f}} sats per winner"
+)
+
+_LUCKY_TMPL = (
+    f"🍀 <b>Lucky Statistics</b>\n\n"
+    f"<b>Chance:</b> {LUCKY_VOUCHER_CHANCE * 100:.2f}% per claim\n"
+    f"<b>Bonus:</b> {LUCKY_VOUCHER_AMOUNT:,} sats\n"
+    f"<b>Total winners:</b> {{wins}}\n"
+    f"<b>Total distributed:</b> {{amount:,}} sats\n\n"
+)
+
+def _render_qr_png(lnurl: str) -> bytes:
+    """Render the voucher QR code as PNG bytes"""
+    # Error level L is plenty for an LNURL and keeps the symbol small
+    qr = segno.make_qr(lnurl, error="L")
+    buf = BytesIO()
+    qr.save(buf, kind="png", scale=8, border=2)
+    return buf.getvalue()
+
 def send_voucher(update: Update, lnurl: str, link_id: str, username: str, bonus: bool = False):
+    if _send_voucher_text(update, lnurl, username, bonus):
+        QR_POOL.submit(_send_voucher_qr, update, lnurl, bonus)
+
+def _send_voucher_text(update: Update, lnurl: str, username: str, bonus: bool) -> bool:
     amount = LUCKY_VOUCHER_AMOUNT if bonus else MIN_WITHDRAWABLE_SATS
     
-    # Validate LNURL format
-    if not lnurl.startswith('LNURL') or not re.match(r'^LNURL[0-9A-Z]+$', lnurl.upper()):
+    # Validate LNURL format (stored LNURLs are already upper-cased on import)
+    if not _LNURL_RE.match(lnurl):
         logger.error(f"Invalid LNURL format: {lnurl}")
         update.message.reply_text("Error: Invalid voucher format. Please contact admin.")
-        return
+        return False
     
     if bonus:
         # Record the lucky win
         record_lucky_win(str(update.effective_chat.id), username, amount)
-        
-        # Lucky bonus message with clean formatting
-        text = (
-            f"🍀 <b>Lucky Bonus!</b>\n"
-            f"You've won an additional <b>{amount:,} sats</b>, @{username}!\n\n"
-            f"<b>Voucher Code:</b>\n"
-            f"<code>{lnurl}</code>\n\n"
-            f"💡 <i>Tap the code above to copy it, then paste into your Lightning wallet</i>"
-        )
-        
-    else:
-        # Regular voucher message
-        text = (
-            f"Here are your <b>{amount} sats</b>, @{username}.\n\n"
-            f"<b>Voucher Code:</b>\n"
-            f"<code>{lnurl}</code>\n\n"
-            f"💡 <i>Tap the code above to copy it, then paste into your Lightning wallet</i>"
-        )
-        
-        if LUCKY_VOUCHER_ENABLED:
-            chance_percent = LUCKY_VOUCHER_CHANCE * 100
-            text += f"\n\n🎯 <i>You had a {chance_percent:.2f}% chance for a {LUCKY_VOUCHER_AMOUNT:,} sat bonus</i>"
-    
+
     # Send message with HTML formatting
-    update.message.reply_text(text, parse_mode=ParseMode.HTML)
+    template = _TEMPLATE_BONUS if bonus else _TEMPLATE_NORMAL
+    update.message.reply_text(template.format(u=username, l=lnurl), parse_mode=ParseMode.HTML)
+    return True
 
-    # Generate and send QR code
+def _send_voucher_qr(update: Update, lnurl: str, bonus: bool):
+    # Generate the QR code; upload failures are logged by MQBot once the
+    # queued send runs
     try:
-        qr = qrcode.QRCode(box_size=8, border=2)
-        qr.add_data(lnurl)
-        qr.make(fit=True)
-        img = qr.make_image()
-        buf = BytesIO()
-        img.save(buf, format="PNG")
-        buf.seek(0)
-        buf.name = f"{'lucky_' if bonus else ''}voucher.png"
-        
-        caption = f"{'🍀 Lucky Bonus' if bonus else '⚡ Lightning'} Voucher QR"
-        update.message.reply_photo(photo=InputFile(buf), caption=caption)
-        
-        logger.info(f"Sent {'lucky ' if bonus else ''}voucher QR for LNURL: {lnurl[:20]}...")
-        
+        png = _render_qr_png(lnurl)
     except Exception as e:
         logger.error(f"Failed to generate QR code: {e}")
         update.message.reply_text("QR code generation failed. Please use the voucher code above.")
+        return
+
+    caption = f"{'🍀 Lucky Bonus' if bonus else '⚡ Lightning'} Voucher QR"
+    photo = InputFile(png, filename=f"{'lucky_' if bonus else ''}voucher.png")
+    update.message.reply_photo(photo=photo, caption=caption)
+    logger.info(f"Queued {'lucky ' if bonus else ''}voucher QR for LNURL: {lnurl[:20]}...")
 
 def start_command(update: Update, context: CallbackContext):
     cid = str(update.effective_chat.id)
@@ -402,32 +525,17 @@ def start_command(update: Update, context: CallbackContext):
         handle_claim(update, context, usr, cid, is_admin)
     else:
         # Enhanced welcome message
-        welcome_text = (
-            f"⚡ <b>Lightning Voucher Bot</b>\n\n"
-            f"Welcome @{usr}! Get your free <b>{MIN_WITHDRAWABLE_SATS} sats</b> with /getvoucher\n\n"
-        )
-        
-        if LUCKY_VOUCHER_ENABLED:
-            chance_percent = LUCKY_VOUCHER_CHANCE * 100
-            total_wins, total_amount = get_lucky_stats()
-            welcome_text += (
-                f"🍀 <b>Lucky Feature Active!</b>\n"
-                f"• {chance_percent:.2f}% chance to win <b>{LUCKY_VOUCHER_AMOUNT:,} bonus sats</b>\n"
-                f"• {total_wins} lucky winners so far\n"
-                f"• {total_amount:,} bonus sats distributed\n\n"
-            )
-        
-        welcome_text += (
-            f"<b>Commands:</b>\n"
-            f"• /getvoucher - Claim your sats\n"
-            f"• /info - About lucky bonuses\n"
-            f"• /lucky - Lucky statistics"
-        )
-        
+        total_wins, total_amount = get_lucky_stats()
+        welcome_text = _WELCOME_TMPL.format(usr=usr, wins=total_wins, amount=total_amount)
         update.message.reply_text(welcome_text, parse_mode=ParseMode.HTML)
 
 def handle_claim(update: Update, context: CallbackContext, username: str, chat_id: str, is_admin: bool):
     if not is_admin and has_received(chat_id):
+        claim = None
+    else:
+        claim = assign_voucher(chat_id, is_admin=is_admin)
+
+    if claim is None:
         update.message.reply_text(
             f"You've already claimed your <b>{MIN_WITHDRAWABLE_SATS} sats</b>, @{username}.\n"
             f"Each user can only claim once to keep it fair for everyone.",
@@ -435,7 +543,7 @@ def handle_claim(update: Update, context: CallbackContext, username: str, chat_i
         )
         return
 
-    normal, lucky = assign_voucher(chat_id, is_admin=is_admin)
+    normal, lucky, free_normal, free_lucky = claim
     
     if normal:
         lnurl_n, lid_n = normal
@@ -447,10 +555,10 @@ def handle_claim(update: Update, context: CallbackContext, username: str, chat_i
     else:
         update.message.reply_text(
             "No vouchers available right now.\n"
-            "The admin has been notified to refill the supply."
+            "A new batch is on its way, please try again in a minute."
         )
     
-    check_voucher_supply()
+    refill_if_low(free_normal, free_lucky)
 
 def getvoucher_command(update: Update, context: CallbackContext):
     cid = str(update.effective_chat.id)
@@ -463,19 +571,11 @@ def info_command(update: Update, context: CallbackContext):
         update.message.reply_text("Lucky bonuses are currently disabled.")
         return
     
-    chance_percent = LUCKY_VOUCHER_CHANCE * 100
     total_wins, total_amount = get_lucky_stats()
-    
-    info_text = (
-        f"🍀 <b>Lucky Bonus Feature</b>\n\n"
-        f"<b>How it works:</b>\n"
-        f"• {chance_percent:.2f}% chance per claim\n"
-        f"• Winners get an extra <b>{LUCKY_VOUCHER_AMOUNT:,} sats</b>\n"
-        f"• Completely random and automatic\n\n"
-        f"<b>Statistics:</b>\n"
-        f"• {total_wins} lucky winners\n"
-        f"• {total_amount:,} bonus sats distributed\n"
-        f"• Average: {(total_amount / max(total_wins, 1)):,.0f} sats per winner"
+    info_text = _INFO_TMPL.format(
+        wins=total_wins,
+        amount=total_amount,
+        average=total_amount / max(total_wins, 1)
     )
     
     update.message.reply_text(info_text, parse_mode=ParseMode.HTML)
@@ -486,24 +586,14 @@ def lucky_command(update: Update, context: CallbackContext):
         return
     
     total_wins, total_amount = get_lucky_stats()
-    chance_percent = LUCKY_VOUCHER_CHANCE * 100
     
-    conn = sqlite3.connect("db.sqlite3", timeout=10)
-    c = conn.cursor()
-    c.execute(
-        "SELECT username, amount, won_at FROM lucky_wins "
-        "ORDER BY won_at DESC LIMIT 5"
-    )
-    recent_winners = c.fetchall()
-    conn.close()
+    with POOL.acquire() as conn:
+        recent_winners = conn.execute(
+            "SELECT username, amount, won_at FROM lucky_wins "
+            "ORDER BY won_at DESC LIMIT 5"
+        ).fetchall()
     
-    stats_text = (
-        f"🍀 <b>Lucky Statistics</b>\n\n"
-        f"<b>Chance:</b> {chance_percent:.2f}% per claim\n"
-        f"<b>Bonus:</b> {LUCKY_VOUCHER_AMOUNT:,} sats\n"
-        f"<b>Total winners:</b> {total_wins}\n"
-        f"<b>Total distributed:</b> {total_amount:,} sats\n\n"
-    )
+    stats_text = _LUCKY_TMPL.format(wins=total_wins, amount=total_amount)
     
     if recent_winners:
         stats_text += "<b>Recent winners:</b>\n"
@@ -519,32 +609,21 @@ def stats_command(update: Update, context: CallbackContext):
     if update.effective_user.id != ADMIN_TELEGRAM_ID:
         return
     
-    conn = sqlite3.connect("db.sqlite3", timeout=10)
-    c = conn.cursor()
-    
-    # Regular voucher stats - only count valid LNURLs
-    c.execute("SELECT COUNT(*) FROM vouchers WHERE assigned_to IS NOT NULL AND bonus = 0 AND lnurl LIKE 'LNURL%'")
-    used_normal = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM vouchers WHERE assigned_to IS NULL AND bonus = 0 AND lnurl LIKE 'LNURL%'")
-    free_normal = c.fetchone()[0]
-    
-    # Lucky voucher stats
-    c.execute("SELECT COUNT(*) FROM vouchers WHERE assigned_to IS NOT NULL AND bonus = 1 AND lnurl LIKE 'LNURL%'")
-    used_lucky = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM vouchers WHERE assigned_to IS NULL AND bonus = 1 AND lnurl LIKE 'LNURL%'")
-    free_lucky = c.fetchone()[0]
-    
-    # Count invalid entries
-    c.execute("SELECT COUNT(*) FROM vouchers WHERE lnurl NOT LIKE 'LNURL%'")
-    invalid_entries = c.fetchone()[0]
+    # One pass over the table instead of a COUNT per bucket
+    with POOL.acquire() as conn:
+        row = conn.execute("""
+            SELECT
+                COALESCE(SUM(assigned_to IS NOT NULL AND bonus = 0 AND valid), 0),
+                COALESCE(SUM(assigned_to IS NULL AND bonus = 0 AND valid), 0),
+                COALESCE(SUM(assigned_to IS NOT NULL AND bonus = 1 AND valid), 0),
+                COALESCE(SUM(assigned_to IS NULL AND bonus = 1 AND valid), 0),
+                COALESCE(SUM(NOT valid), 0)
+            FROM (SELECT assigned_to, bonus, lnurl LIKE 'LNURL%' AS valid FROM vouchers)
+        """).fetchone()
+    used_normal, free_normal, used_lucky, free_lucky, invalid_entries = row
     
     # Lucky wins
-    c.execute("SELECT COUNT(*), SUM(amount) FROM lucky_wins")
-    result = c.fetchone()
-    total_lucky_wins = result[0] or 0
-    total_lucky_amount = result[1] or 0
-    
-    conn.close()
+    total_lucky_wins, total_lucky_amount = get_lucky_stats()
     
     stats_text = (
         f"📊 <b>Admin Statistics</b>\n\n"
@@ -580,28 +659,95 @@ def error_handler(update: object, context: CallbackContext):
     logger.exception("Error while handling update: %s", context.error)
     raise DispatcherHandlerStop()
 
-def check_voucher_supply():
-    conn = sqlite3.connect("db.sqlite3", timeout=10)
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM vouchers WHERE assigned_to IS NULL AND bonus = 0 AND lnurl LIKE 'LNURL%'")
-    free_normal = c.fetchone()[0]
-    conn.close()
-    
-    threshold = max(10, VOUCHER_BATCH_SIZE // 10)
+# === 6. Background refills ===
+REFILL_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="refill")
+_refill_in_flight = threading.Event()
+_refill_lock = threading.Lock()
+
+def schedule_refill(*jobs):
+    """Run refill jobs in the background unless a refill is already running.
+
+    Returns True if the jobs were scheduled.
+    """
+    with _refill_lock:
+        if _refill_in_flight.is_set():
+            return False
+        _refill_in_flight.set()
+    REFILL_EXECUTOR.submit(_run_refill, jobs)
+    return True
+
+def _run_refill(jobs):
+    try:
+        for job in jobs:
+            job()
+    except Exception:
+        logger.exception("Voucher refill failed")
+    finally:
+        _refill_in_flight.clear()
+
+def refill_if_low(free_normal: int, free_lucky: int):
+    """Schedule refills based on the free counts reported by assign_voucher"""
+    jobs = []
+    # Refill at a quarter of a batch so the new one lands before the pool runs dry
+    threshold = max(10, VOUCHER_BATCH_SIZE // 4)
     if free_normal < threshold:
-        logger.info("Normal voucher supply low (%d), refilling...", free_normal)
-        create_voucher_group()
-
-    if LUCKY_VOUCHER_ENABLED:
-        conn = sqlite3.connect("db.sqlite3", timeout=10)
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM vouchers WHERE assigned_to IS NULL AND bonus = 1 AND lnurl LIKE 'LNURL%'")
-        free_lucky = c.fetchone()[0]
-        conn.close()
-        
-        if free_lucky == 0:
+        jobs.append(create_voucher_group)
+    if LUCKY_VOUCHER_ENABLED and free_lucky == 0:
+        jobs.append(create_lucky_vouchers)
+
+    # Claims keep reporting low supply while a refill runs; only log the one
+    # that actually starts it
+    if jobs and schedule_refill(*jobs):
+        if create_voucher_group in jobs:
+            logger.info("Normal voucher supply low (%d), refilling...", free_normal)
+        if create_lucky_vouchers in jobs:
             logger.info("Lucky voucher pool empty, refilling...")
-            create_lucky_vouchers()
+
+# === 7. Rate-limited bot ===
+class MQBot(Bot):
+    """Bot that spaces out its replies through a MessageQueue to stay under
+    Telegram's flood limits: 30 messages/s overall, plus 20/min for groups.
+
+    MessageQueue has a single group queue, so the 20/min is one budget shared
+    by all groups and channels together; a busy group can hold back replies
+    to every other group for minutes, and the shutdown drain may give up on
+    them. There is no per-chat limiter, so private chats are only bound by
+    the overall limit; a claim sends two messages to one chat, which
+    Telegram tolerates as a short burst.
+    """
+
+    def __init__(self, *args, mqueue=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._msg_queue = mqueue or mq.MessageQueue()
+
+    def _queue(self, send, chat_id, *args, **kwargs):
+        # Group and channel ids are negative (or @usernames for channels)
+        is_group = str(chat_id).startswith(("-", "@"))
+        promise = Promise(_logged_send, (send, chat_id) + args, kwargs)
+        return self._msg_queue(promise, is_group)
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self._queue(super().send_message, chat_id, *args, **kwargs)
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return self._queue(super().send_photo, chat_id, *args, **kwargs)
+
+def _logged_send(send, chat_id, *args, **kwargs):
+    # Queued sends run in the MessageQueue thread and their Promise keeps any
+    # exception to itself, so log failures here
+    try:
+        return send(chat_id, *args, **kwargs)
+    except Exception as e:
+        logger.error("Failed to %s to chat %s: %s", send.__name__, chat_id, e)
+        raise
+
+def drain_message_queue(mqueue, timeout: float = 10):
+    """Wait until the replies queued so far have gone out"""
+    # The marker passes the group queue and then the overall queue, so it
+    # runs only after everything queued ahead of it
+    drained = threading.Event()
+    mqueue(drained.set, True)
+    return drained.wait(timeout)
 
 def main():
     init_db()
@@ -609,32 +755,55 @@ def main():
     # Clean up any existing invalid entries
     clean_database()
     
-    create_lucky_vouchers()
-    create_voucher_group()
-
-    updater = Updater(token=TELEGRAM_BOT_TOKEN, use_context=True)
+    # Both batches are independent LNbits round trips, so create them in parallel
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(create_lucky_vouchers), executor.submit(create_voucher_group)]
+        for future in futures:
+            future.result()
+
+    mqueue = mq.MessageQueue(
+        all_burst_limit=30,
+        all_time_limit_ms=1000,
+        group_burst_limit=20,
+        group_time_limit_ms=60000
+    )
+    # One connection per dispatcher worker plus headroom for the updater itself
+    bot = MQBot(TELEGRAM_BOT_TOKEN, request=Request(con_pool_size=8), mqueue=mqueue)
+    updater = Updater(bot=bot, use_context=True)
     dp = updater.dispatcher
 
-    dp.add_handler(CommandHandler("start", start_command))
-    dp.add_handler(CommandHandler("getvoucher", getvoucher_command))
-    dp.add_handler(CommandHandler("info", info_command))
-    dp.add_handler(CommandHandler("lucky", lucky_command))
-    dp.add_handler(CommandHandler("stats", stats_command))
-    dp.add_handler(CommandHandler("cleanup", cleanup_command))
+    # Handlers run on the dispatcher's worker pool so concurrent users don't queue
+    # behind each other's SQLite and Telegram round trips; each one takes its
+    # own connection from POOL
+    dp.add_handler(CommandHandler("start", start_command, run_async=True))
+    dp.add_handler(CommandHandler("getvoucher", getvoucher_command, run_async=True))
+    dp.add_handler(CommandHandler("info", info_command, run_async=True))
+    dp.add_handler(CommandHandler("lucky", lucky_command, run_async=True))
+    dp.add_handler(CommandHandler("stats", stats_command, run_async=True))
+    dp.add_handler(CommandHandler("cleanup", cleanup_command, run_async=True))
     dp.add_error_handler(error_handler)
 
-    updater.start_polling()
+    if TELEGRAM_WEBHOOK_URL:
+        updater.start_webhook(
+            listen=TELEGRAM_WEBHOOK_LISTEN,
+            port=TELEGRAM_WEBHOOK_PORT,
+            url_path=TELEGRAM_BOT_TOKEN,
+            webhook_url=f"{TELEGRAM_WEBHOOK_URL.rstrip('/')}/{TELEGRAM_BOT_TOKEN}"
+        )
+    else:
+        updater.start_polling()
     logger.info("🤖 Fixed Voucher Bot is running.")
 
-    def stop(signum, frame):
-        logger.info("📉 Shutting down…")
-        updater.stop()
-        updater.is_idle = False
-
-    signal.signal(signal.SIGINT, stop)
-    signal.signal(signal.SIGTERM, stop)
+    # PTB stops the updater and drains pending updates on these signals
+    updater.idle(stop_signals=(signal.SIGINT, signal.SIGTERM))
+    logger.info("📉 Shutting down…")
 
-    updater.idle()
+    # Handlers have finished by now; let pending QR uploads reach the queue
+    # and flush it, so claimed vouchers still get their replies
+    QR_POOL.shutdown(wait=True)
+    if not drain_message_queue(mqueue):
+        logger.warning("Stopping with replies still queued")
+    mqueue.stop()
     logger.info("⏹️ Bot stopped.")
 
 if __name__ == "__main__":